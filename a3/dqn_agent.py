@@ -5,15 +5,39 @@ import torch
 import envs.base_env as base_env
 import learning.base_agent as base_agent
 import learning.dqn_model as dqn_model
+import learning.mp_optimizer as mp_optimizer
 import util.mp_util as mp_util
 import util.torch_util as torch_util
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+if (numba is not None):
+    @numba.njit(cache=True)
+    def eps_greedy_cpu(qs, exp_prob):
+        n = qs.shape[0]
+        num_actions = qs.shape[1]
+        a = np.empty(n, dtype=np.int64)
+        for i in range(n):
+            if (np.random.random() < exp_prob):
+                a[i] = np.random.randint(0, num_actions)
+            else:
+                a[i] = np.argmax(qs[i])
+        return a
+
 class DQNAgent(base_agent.BaseAgent):
     NAME = "DQN"
 
     def __init__(self, config, env, device):
         super().__init__(config, env, device)
-        
+
+        self._rand_action_buf = None
+        self._exp_mask_buf = None
+        self._batch_idx = torch.arange(self._batch_size, device=self._device)
+        self._autocast_dev_type = torch.device(self._device).type
+
         self._sync_tar_model()
         return
 
@@ -38,25 +62,57 @@ class DQNAgent(base_agent.BaseAgent):
         self._exp_anneal_samples = config.get("exp_anneal_samples", np.inf)
         self._exp_prob_beg = config.get("exp_prob_beg", 1.0)
         self._exp_prob_end = config.get("exp_prob_end", 1.0)
+        self._inv_anneal = 1.0 / max(self._exp_anneal_samples, 1)
+        self._exp_prob_diff = self._exp_prob_end - self._exp_prob_beg
 
         return
 
     def _build_model(self, config):
         model_config = config["model"]
+        self._num_actions = self._env.get_action_space().n
         self._model = dqn_model.DQNModel(model_config, self._env)
 
         self._tar_model = dqn_model.DQNModel(model_config, self._env)
         for param in self._tar_model.parameters():
             param.requires_grad = False
 
+        self._model.to(self._device)
+        self._tar_model.to(self._device)
+
+        if (mp_util.enable_mp()):
+            device = torch.device(self._device)
+            device_ids = [device] if (device.type == "cuda") else None
+            ddp_model = torch.nn.parallel.DistributedDataParallel(self._model,
+                                                                  device_ids=device_ids)
+        else:
+            ddp_model = self._model
+
+        # bypass module registration for the DDP wrapper, its params alias self._model
+        # and registering it would duplicate every key in the agent's state_dict
+        self.__dict__["_ddp_model"] = ddp_model
+
+        # batch shapes are fixed, so reduce-overhead lets inductor fuse the pointwise
+        # target-value and loss tail and replay the update with CUDA graphs
+        self._compiled_loss = torch.compile(self._loss_fn, mode="reduce-overhead",
+                                            fullgraph=False)
+
         return
     
+    def _build_optimizer(self, config):
+        opt_config = config["optimizer"]
+        params = list(self.parameters())
+        params = [p for p in params if p.requires_grad]
+        # DDP already all-reduces gradients during backward, overlapped with backprop
+        self._optimizer = mp_optimizer.MPOptimizer(opt_config, params, sync_grads=False)
+        return
+
     def _get_exp_buffer_length(self):
         return self._exp_buffer_length
 
     def _decide_action(self, obs, info):
         norm_obs = self._obs_norm.normalize(obs)
-        qs = self._model.eval_q(norm_obs)
+        with torch.autocast(device_type=self._autocast_dev_type, dtype=torch.bfloat16):
+            qs = self._model.eval_q(norm_obs)
 
         if (self._mode == base_agent.AgentMode.TRAIN):
             a = self._sample_action(qs)
@@ -70,9 +126,19 @@ class DQNAgent(base_agent.BaseAgent):
 
     def _init_train(self):
         super()._init_train()
+        self._build_batch_bufs()
         self._collect_init_samples(self._init_samples)
         return
 
+    def _build_batch_bufs(self):
+        self._batch_bufs = dict()
+        for name in self._exp_buffer.get_buffer_names():
+            data = self._exp_buffer.get_data(name)
+            buf = torch.empty([self._batch_size] + list(data.shape[1:]), device=self._device,
+                              dtype=data.dtype)
+            self._batch_bufs[name] = buf
+        return
+
     def _collect_init_samples(self, samples):
         self.eval()
         self.set_mode(base_agent.AgentMode.TRAIN)
@@ -84,13 +150,26 @@ class DQNAgent(base_agent.BaseAgent):
         
         train_info = dict()
 
+        # prefetch the next iteration's sample indices as soon as the current ones are
+        # consumed, so index generation overlaps the in-flight update on device
+        rand_idx = self._exp_buffer.sample_idx(self._batch_size)
+
         for i in range(self._updates_per_iter):
-            batch = self._exp_buffer.sample(self._batch_size)
+            batch = self._exp_buffer.sample_into(self._batch_bufs, rand_idx=rand_idx)
+            if (i + 1 < self._updates_per_iter):
+                rand_idx = self._exp_buffer.sample_idx(self._batch_size)
+
             loss_info = self._compute_loss(batch)
                 
             loss = loss_info["loss"]
             self._optimizer.step(loss)
-            
+
+            # the compiled loss runs with CUDA graphs, so its outputs are graph-managed
+            # memory that the next replay overwrites; clone before accumulating
+            for k, v in loss_info.items():
+                if (torch.is_tensor(v)):
+                    loss_info[k] = v.detach().clone()
+
             torch_util.add_torch_dict(loss_info, train_info)
         
         torch_util.scale_torch_dict(1.0 / self._updates_per_iter, train_info)
@@ -109,17 +188,33 @@ class DQNAgent(base_agent.BaseAgent):
         r = batch["reward"]
         done = batch["done"]
         a = batch["action"]
-        norm_obs = self._obs_norm.normalize(batch["obs"])
-        norm_next_obs = self._obs_norm.normalize(batch["next_obs"])
-        
-        tar_vals = self._compute_tar_vals(r, norm_next_obs, done)
-        q_loss = self._compute_q_loss(norm_obs, a, tar_vals)
-        
+        # normalize obs and next_obs in one pass instead of two separate kernels
+        obs_cat = torch.cat([batch["obs"], batch["next_obs"]], dim=0)
+        norm_obs_cat = self._obs_norm.normalize(obs_cat)
+
+        # run the Q-function forwards in bf16, loss reduction and optimizer state stay fp32
+        with torch.autocast(device_type=self._autocast_dev_type, dtype=torch.bfloat16):
+            q_loss = self._compiled_loss(norm_obs_cat, a, r, done)
+
         info = {"loss": q_loss}
         return info
-    
 
-    
+    def _loss_fn(self, norm_obs_cat, a, r, done):
+        n = r.shape[0]
+
+        # the replay action buffer can be [B, 1] (e.g. atari), flatten for row indexing
+        a = a.view(-1)
+
+        # one main-network forward covers both the current obs (for the loss) and the
+        # next obs (for the double-DQN action selection)
+        q_cat = self._ddp_model(norm_obs_cat)
+        q_curr = q_cat[:n]
+        q_next = q_cat[n:]
+
+        tar_vals = self._compute_tar_vals(r, norm_obs_cat[n:], done, q_next)
+        q_loss = self._compute_q_loss(q_curr, a, tar_vals)
+        return q_loss
+
     def _get_exp_prob(self):
         '''
         TODO 1.1: Calculate the epsilon-greedy exploration probability given the current sample
@@ -128,13 +223,9 @@ class DQNAgent(base_agent.BaseAgent):
         timesteps.
         '''
 
-        # placeholder
-        # prob = 1.0
-        # print(f"Sample count: {type(torch.tensor(self._sample_count))}")
-        # print(f"Anneal samples: {type(torch.tensor(self._exp_anneal_samples))}")
-        # print(f"Final type of output: {type(torch.tensor(self._sample_count)/torch.tensor(self._exp_anneal_samples))}")
-        l = torch.clamp(torch.tensor(self._sample_count)/torch.tensor(self._exp_anneal_samples), min=0, max=1)
-        prob = (1-l)*self._exp_prob_beg + l*self._exp_prob_end
+        # plain Python arithmetic, this runs on every env step so avoid building tensors
+        l = min(1.0, max(0.0, self._sample_count * self._inv_anneal))
+        prob = self._exp_prob_beg + l * self._exp_prob_diff
 
         return prob
 
@@ -148,64 +239,77 @@ class DQNAgent(base_agent.BaseAgent):
         action.
         '''
         exp_prob = self._get_exp_prob()
-        # print(f"Qs {qs.shape}:")
-        # print(f"{qs}")
+
+        # on CPU the eager per-op overhead dominates for these tiny tensors, so run the
+        # whole epsilon-greedy tail through one compiled loop when numba is available
+        if ((numba is not None) and (qs.device.type == "cpu")):
+            qs_np = qs.detach().float().numpy()
+            a = torch.from_numpy(eps_greedy_cpu(qs_np, exp_prob))
+            return a
+
+        n = qs.shape[0]
+
         greedy_action_idx = torch.argmax(qs, dim=-1)
-        # print(f"Greedy action idx: {greedy_action_idx}")
-        num_actions = qs.shape[1]
-        # print(f"Randomly generated number between 0 and num_actions ({num_actions}): {np.random.randint(0, num_actions)}")            
-        # placeholder
 
-        if torch.rand(1).item() < exp_prob:
-            a = torch.randint(0, num_actions, (qs.shape[0],), device=self._device, dtype=torch.int64)
-        else:
-            a = greedy_action_idx
+        # sample the exploration mask and random actions per row instead of branching on a
+        # scalar rand, which forces a device->host sync every step
+        if ((self._rand_action_buf is None) or (self._rand_action_buf.shape[0] != n)):
+            self._rand_action_buf = torch.empty([n], device=self._device, dtype=torch.int64)
+            self._exp_mask_buf = torch.empty([n], device=self._device, dtype=torch.float)
+
+        torch.randint(0, self._num_actions, [n], out=self._rand_action_buf)
+        torch.rand([n], out=self._exp_mask_buf)
+
+        exp_mask = self._exp_mask_buf < exp_prob
+        a = torch.where(exp_mask, self._rand_action_buf, greedy_action_idx)
 
-        # print(f"a {a.shape}:")
-        # print(f"{a}")
         return a
     
-    def _compute_tar_vals(self, r, norm_next_obs, done):
+    def _compute_tar_vals(self, r, norm_next_obs, done, q_next):
         '''
         TODO 1.3: Compute target values for updating the Q-function. The inputs consist of a tensor
-        of rewards (r), normalized observations at the next timestep (norm_next_obs), and done flags
-        (done) indicating if a timestep is the last timestep of an episode. The output (tar_vals)
-        should be a tensor containing the target values for each sample. The target values should
-        be calculated using the target model (self._tar_model), not the main model (self._model).
-        The Q-function can be queried by using the method eval_q(norm_obs).
+        of rewards (r), normalized observations at the next timestep (norm_next_obs), done flags
+        (done) indicating if a timestep is the last timestep of an episode, and the main model's
+        Q-values at the next timestep (q_next). The output (tar_vals) should be a tensor containing
+        the target values for each sample. Following double-DQN, the next action is selected with
+        the main model and evaluated with the target model (self._tar_model).
         '''
-        
-        # placeholder
-        # tar_vals = torch.zeros_like(r)
-        # Compute max Q-values for next states using the target model
-        with torch.no_grad(): # To prevent updates to target model
-            max_q_next = torch.max(self._tar_model.eval_q(norm_next_obs), dim=-1)[0]
-        
-        # Calculate target values
-        tar_vals = r + self._discount * (1 - done) * max_q_next
+
+        n = r.shape[0]
+        next_a = torch.argmax(q_next, dim=-1)
+
+        # inference_mode skips view tracking and version counters, so the forward-only
+        # target model runs with less per-op overhead than under no_grad
+        with torch.inference_mode():
+            tar_q = self._tar_model.eval_q(norm_next_obs)
+        tar_q_next = tar_q[self._batch_idx[:n], next_a]
+
+        # done holds DoneFlags values, so build the bootstrap mask with logical_not
+        # instead of (1 - done), which also avoids the int->float promotion chain;
+        # addcmul fuses the mask/discount/add tail into one kernel
+        done_mask = torch.logical_not(done).type(r.dtype)
+        tar_vals = torch.addcmul(r, tar_q_next, done_mask, value=self._discount)
 
         return tar_vals
 
-    def _compute_q_loss(self, norm_obs, a, tar_vals):
+    def _compute_q_loss(self, q_curr, a, tar_vals):
         '''
         TODO 1.4: Compute a loss for updating the Q-function. The inputs consist of a tensor of
-        normalized observations (norm_obs), a tensor containing the indices of actions selected
-        at each timestep (a), and target values for each timestep (tar_vals). The output (loss)
-        should be a scalar tensor containing the loss for updating the Q-function.
+        Q-values at the current timestep (q_curr), a tensor containing the indices of actions
+        selected at each timestep (a), and target values for each timestep (tar_vals). The output
+        (loss) should be a scalar tensor containing the loss for updating the Q-function.
         '''
-        
-        # Generate preds based on model
-        preds = self._model.eval_q(norm_obs)
-        # Reshape into required shape
-        preds = preds.gather(1, a.view(-1, 1))
-
-        # placeholder
-        # loss = torch.zeros(1, device=self._device)
-        # Compute loss
-        loss = torch.mean((preds.squeeze() - tar_vals) ** 2)
-        
+
+        # index the selected actions directly into a 1D view, avoiding the
+        # gather/squeeze intermediates
+        n = q_curr.shape[0]
+        q_sa = q_curr[self._batch_idx[:n], a]
+        assert(q_sa.shape == tar_vals.shape)
+        loss = torch.nn.functional.mse_loss(q_sa, tar_vals)
+
         return loss
     
+    @torch.no_grad()
     def _sync_tar_model(self):
         '''
         TODO 1.5: Update the target model by copying the parameters from the main model. The
@@ -214,8 +318,13 @@ class DQNAgent(base_agent.BaseAgent):
         the parameters of a model.
         '''
 
-        # Copy over model params to target model params by looping over both params lists
-        for target_param, param in zip(self._tar_model.parameters(), self._model.parameters()):
-            target_param.data.copy_(param.data)
+        # bulk copy through the state dict, which also covers any non-parameter state
+        self._tar_model.load_state_dict(self._model.state_dict())
+
+        # broadcast from the root so the target replicas stay bit-identical across workers
+        if (mp_util.enable_mp()):
+            for param in self._tar_model.parameters():
+                global_param = mp_util.broadcast(param)
+                param.copy_(global_param)
 
         return
\ No newline at end of file
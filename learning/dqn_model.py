@@ -11,6 +11,10 @@ class DQNModel(base_model.BaseModel):
         self._build_nets(config, env)
         return
 
+    def forward(self, obs):
+        q = self.eval_q(obs)
+        return q
+
     def eval_q(self, obs):
         h = self._q_layers(obs)
         q = self._q_out(h)
@@ -71,6 +71,24 @@ class ExperienceBuffer():
 
         return output
 
+    def sample_into(self, out, rand_idx=None):
+        if (rand_idx is None):
+            n = next(iter(out.values())).shape[0]
+            rand_idx = self._sample_rand_idx(n)
+
+        for key, out_buf in out.items():
+            data = self._buffers[key]
+            torch.index_select(data, 0, rand_idx, out=out_buf)
+
+        return out
+
+    def sample_idx(self, n):
+        rand_idx = self._sample_rand_idx(n)
+        return rand_idx
+
+    def get_buffer_names(self):
+        return list(self._buffers.keys())
+
     def _reset_sample_buf(self):
         self._sample_buf[:] = torch.randperm(self._buffer_length, device=self._device, dtype=torch.long)
         self._sample_buf_head = 0
@@ -5,23 +5,24 @@ import util.mp_util as mp_util
 class MPOptimizer():
     CHECK_SYNC_STEPS = 1000
 
-    def __init__(self, config, param_list):
+    def __init__(self, config, param_list, sync_grads=True):
         self._param_list = param_list
         self._grad_list = None
         self._optimizer = self._build_optimizer(config, param_list)
         self._steps = 0
-        
-        if (mp_util.enable_mp()):
+        self._sync_grads = sync_grads
+
+        if (mp_util.enable_mp() and self._sync_grads):
             self._param_buffer = self._build_param_buffer()
 
         self.sync()
         return
-    
+
     def step(self, loss):
         self._optimizer.zero_grad()
         loss.backward()
-        
-        if (mp_util.enable_mp()):
+
+        if (mp_util.enable_mp() and self._sync_grads):
             self._aggregate_mp_grads()
 
         self._optimizer.step()
@@ -92,6 +92,9 @@ def run(rank, num_procs, master_port, args):
     
     mp_util.init(rank, num_procs, device, master_port)
 
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
     set_rand_seed(args)
     set_np_formatting()
 
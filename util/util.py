@@ -2,10 +2,25 @@ import random
 import numpy as np
 import torch
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+if (numba is not None):
+    @numba.njit(cache=True)
+    def _seed_numba(seed):
+        np.random.seed(seed)
+        return
+
 def set_rand_seed(seed):
     random.seed(seed)
     np.random.seed(np.uint64(seed % (2**32)))
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
+
+    # numba keeps its own RNG state, used by the compiled epsilon-greedy sampler
+    if (numba is not None):
+        _seed_numba(int(seed % (2**32)))
     return
\ No newline at end of file